@@ -5,25 +5,27 @@ A setuptools based setup module for YubiKit
 
 from setuptools import setup
 from os import path
+from pathlib import Path
 import re
 
 here = path.abspath(path.dirname(__file__))
 
+VERSION_RE = re.compile(rb"^__version__\s*=\s*['\"](.+)['\"]$")
+
 
 def get_version():
     """ Read the current version from __init__.py """
     with open('yubikit/__init__.py', 'rb') as initfile:
-        for line in initfile.readlines():
-            match = re.match(r"^__version__\s*=\s*['\"](.+)['\"]$", line.decode('utf-8'))
+        for line in initfile:
+            match = VERSION_RE.match(line)
             if match:
-                return match.group(1)
+                return match.group(1).decode('utf-8')
         raise RuntimeError("Unable to find version string.")
 
 
 def get_long_description():
     """ Return the content of README """
-    with open('README.rst', 'rb') as readmefile:
-        return readmefile.read().decode('utf-8')
+    return Path('README.rst').read_text(encoding='utf-8')
 
 
 setup(
@@ -37,7 +39,7 @@ setup(
     author_email='oriordan@mail.be',
 
     packages=['yubikit'],
-    install_requires=['pycryptodome', 'requests'],
+    install_requires=['passlib', 'pycryptodome', 'requests'],
     keywords='yubikey otp authentication',
     classifiers=[
         'License :: OSI Approved :: MIT License',
@@ -0,0 +1,52 @@
+import os
+import sqlite3
+
+from passlib.context import CryptContext
+import pytest
+
+from yubikit.config import settings
+
+SQL_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'test')
+
+TEST_DATA = {
+    'ykksm': [
+        "INSERT INTO yubikeys (publicname, internalname, aeskey, serialnr, created, lockcode, creator) "
+        "VALUES ('idkfefrdhtru', '609963eae7b5', 'c68c9df8cbfe7d2f994cb904046c7218', 0, 0, '', '')",
+    ],
+    'ykval': [
+        "INSERT INTO clients (id, active, created, secret) "
+        "VALUES (1, '1', 1383728711, 'EHmo8FMxuhumBlTinC4uYL0Mgwg=')",
+    ],
+    'yubiauth': [
+        "INSERT INTO yubikeys (id, prefix, enabled) VALUES (1, 'idkfefrdhtru', '1')",
+        "INSERT INTO user_yubikeys (user_id, yubikey_id) VALUES (1, 1)",
+    ],
+}
+
+
+@pytest.fixture(scope='session')
+def databases(tmp_path_factory):
+    """ sqlite copies of the test/ databases, loaded with the selftest data """
+    tmpdir = tmp_path_factory.mktemp('db')
+    databases = {}
+    for name, statements in TEST_DATA.items():
+        path = str(tmpdir / ('%s.sqlite' % name))
+        with open(os.path.join(SQL_DIR, '%s-db.sql' % name)) as sqlfile:
+            schema = sqlfile.read()
+        conn = sqlite3.connect(path)
+        conn.executescript(schema)
+        for statement in statements:
+            conn.execute(statement)
+        if name == 'yubiauth':
+            # Hash with the configured policy, so it costs the same as a dummy verify
+            password_hash = CryptContext(**settings['CRYPT_CONTEXT']).hash('0000')
+            conn.execute("INSERT INTO users (id, name, auth) VALUES (1, 'test', ?)", (password_hash,))
+        conn.commit()
+        conn.close()
+        databases[name] = {'ENGINE': 'sqlite', 'NAME': path}
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setitem(settings, 'DATABASES', databases)
+        mp.setitem(settings, 'USE_NATIVE_YKVAL', True)
+        mp.setitem(settings, 'USE_NATIVE_YKKSM', True)
+        yield databases
@@ -0,0 +1,129 @@
+import sqlite3
+
+import pytest
+
+from yubikit.config import settings
+from yubikit.db import MERGE_LOCAL_PARAMS_LUA, ConnectionPool, DBHandler
+
+LOCAL_PARAMS = {
+    'active': 1,
+    'modified': 1000,
+    'yk_publicname': 'cccccccccccd',
+    'yk_counter': 5,
+    'yk_use': 1,
+    'yk_low': 100,
+    'yk_high': 10,
+    'nonce': 'a' * 16,
+}
+CACHE_KEY = 'ykval:yk:cccccccccccd'
+
+
+class DeadConnection:
+    """ Pooled connection whose server went away """
+    closed = False
+
+    def cursor(self):
+        raise sqlite3.OperationalError('server has gone away')
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def handler(databases, monkeypatch):
+    handler = DBHandler(db='ykval')
+    monkeypatch.setattr(handler, 'pool', ConnectionPool(handler._connect, maxcached=4))
+    yield handler
+    handler.pool.clear()
+
+
+def test_retry_skips_stale_pooled_connections(handler):
+    dead = [DeadConnection() for _ in range(4)]
+    for conn in dead:
+        handler.pool._idle.put_nowait(conn)
+    for _ in range(4):
+        assert handler.get_client_data(1)['id'] == 1
+    assert all(conn.closed for conn in dead)
+
+
+class FakeLocalParamsCache:
+    """ The part of a Redis client used by the local params cache """
+    def __init__(self):
+        self.data = {}
+
+    def hgetall(self, key):
+        return dict(self.data.get(key, {}))
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def register_script(self, script):
+        assert script == MERGE_LOCAL_PARAMS_LUA
+        return self.merge
+
+    def merge(self, keys, args):
+        """ What MERGE_LOCAL_PARAMS_LUA does """
+        cached = self.data.setdefault(keys[0], {})
+        newer = ('yk_counter' not in cached or 'yk_use' not in cached
+                 or (int(cached['yk_counter']), int(cached['yk_use'])) < (int(args[1]), int(args[2])))
+        counter_fields = args[4:4 + 2 * args[3]:2]
+        for field, value in zip(args[4::2], args[5::2]):
+            if newer or field not in counter_fields:
+                cached[field] = str(value)
+            else:
+                cached.setdefault(field, str(value))
+        return int(newer)
+
+
+@pytest.fixture(params=['fake', 'fakeredis'])
+def cached_handler(request, databases, monkeypatch):
+    """ DBHandler caching the local params, in a fake client or in fakeredis (running the Lua) """
+    if request.param == 'fakeredis':
+        pytest.importorskip('lupa')
+        cache = pytest.importorskip('fakeredis').FakeRedis(decode_responses=True)
+    else:
+        cache = FakeLocalParamsCache()
+    monkeypatch.setitem(settings, 'LOCAL_PARAMS_CACHE_TTL', 60)
+    handler = DBHandler(db='ykval')
+    monkeypatch.setattr(handler, 'cache', cache)
+    monkeypatch.setattr(handler, '_merge_local_params', cache.register_script(MERGE_LOCAL_PARAMS_LUA),
+                        raising=False)
+    return handler
+
+
+def test_cached_counters_only_move_forward(cached_handler):
+    cached_handler._cache_local_params(LOCAL_PARAMS)
+    assert cached_handler._get_cached_local_params('cccccccccccd') == LOCAL_PARAMS
+    older = dict(LOCAL_PARAMS, modified=900, yk_counter=4, yk_use=9, nonce='b' * 16)
+    cached_handler._cache_local_params(older)
+    assert cached_handler._get_cached_local_params('cccccccccccd') == LOCAL_PARAMS
+    newer = dict(LOCAL_PARAMS, modified=1100, yk_use=2, nonce='c' * 16)
+    cached_handler._cache_local_params(newer)
+    assert cached_handler._get_cached_local_params('cccccccccccd') == newer
+
+
+def test_cached_active_flag_is_refreshed(cached_handler):
+    cached_handler._cache_local_params(LOCAL_PARAMS)
+    cached_handler._cache_local_params(dict(LOCAL_PARAMS, active=0))
+    assert cached_handler._get_cached_local_params('cccccccccccd')['active'] == 0
+
+
+def test_partially_cached_local_params_are_a_miss(cached_handler):
+    # update_db_counters merges the counters only, into an expired entry
+    counters = {key: val for key, val in LOCAL_PARAMS.items() if key != 'active'}
+    cached_handler._cache_local_params(counters)
+    assert cached_handler.cache.hgetall(CACHE_KEY)
+    assert cached_handler._get_cached_local_params('cccccccccccd') is None
+
+
+def test_failed_cache_update_drops_the_entry(cached_handler, monkeypatch):
+    from redis import RedisError
+
+    cached_handler._cache_local_params(LOCAL_PARAMS)
+
+    def merge(keys, args):
+        raise RedisError('connection lost')
+    monkeypatch.setattr(cached_handler, '_merge_local_params', merge)
+    cached_handler._cache_local_params(dict(LOCAL_PARAMS, yk_use=2))
+    assert cached_handler.cache.hgetall(CACHE_KEY) == {}
+    assert cached_handler._get_cached_local_params('cccccccccccd') is None
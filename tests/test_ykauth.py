@@ -0,0 +1,144 @@
+import asyncio
+import time
+
+from passlib.hash import sha256_crypt
+import pytest
+
+from yubikit.exceptions import YKAuthError
+from yubikit.ykauth import Client, VerificationClient
+
+OTP = 'idkfefrdhtrutjduvtcjbfeuvhehdvjjlbchtlenfgku'
+
+
+@pytest.fixture
+def client(databases):
+    return Client()
+
+
+def _failed_auth(client, username, password, otp=OTP):
+    """ Return (best duration, error code) of a few failing authentications """
+    durations = []
+    for _ in range(3):
+        start = time.perf_counter()
+        with pytest.raises(YKAuthError) as err:
+            client.authenticate(username, password, otp)
+        durations.append(time.perf_counter() - start)
+    return min(durations), err.value.error_code
+
+
+def test_unknown_user_costs_a_password_verify(client):
+    bad_password, code = _failed_auth(client, 'test', 'wrong')
+    assert code == 'BAD_PASSWORD'
+    unknown_user, code = _failed_auth(client, 'nobody', 'wrong')
+    assert code == 'UNKNOWN_USER'
+    assert unknown_user >= bad_password / 2
+
+
+def test_invalid_token_costs_a_password_verify(client):
+    bad_password, code = _failed_auth(client, 'test', 'wrong')
+    assert code == 'BAD_PASSWORD'
+    invalid_token, code = _failed_auth(client, 'test', 'wrong', 'cccccccccccc' + OTP[12:])
+    assert code == 'INVALID_TOKEN'
+    assert invalid_token >= bad_password / 2
+
+
+def test_authenticate_async(client):
+    otp = 'idkfefrdhtrurndjtkffvlkeinjtghhcceicfurribeb'
+    with pytest.raises(YKAuthError) as err:
+        asyncio.run(client.authenticate_async('test', 'wrong', otp))
+    assert err.value.error_code == 'BAD_PASSWORD'
+    assert asyncio.run(client.authenticate_async('test', '0000', otp)) is True
+
+
+def test_authenticate_async_unknown_user(client):
+    with pytest.raises(YKAuthError) as err:
+        asyncio.run(client.authenticate_async('nobody', 'wrong', OTP))
+    assert err.value.error_code == 'UNKNOWN_USER'
+
+
+def test_malformed_otp_costs_a_password_verify(client):
+    bad_password, code = _failed_auth(client, 'test', 'wrong')
+    assert code == 'BAD_PASSWORD'
+    bad_otp, code = _failed_auth(client, 'test', 'wrong', OTP[:-1] + 'x')
+    assert code == 'BAD_OTP'
+    assert bad_otp >= bad_password / 2
+
+
+def test_verify_batch(monkeypatch):
+    client = VerificationClient(['http://ykval1', 'http://ykval2'], client_id=1)
+
+    def fetch(url, params):
+        params = dict(params)
+        status = 'OK' if url == 'http://ykval2' else 'REPLAYED_REQUEST'
+        return {'otp': params['otp'], 'nonce': params['nonce'], 'status': status}
+    monkeypatch.setattr(client, '_fetch', fetch)
+    otps = [OTP, 'idkfefrdhtrurndjtkffvlkeinjtghhcceicfurribeb']
+    assert client.verify_batch(otps) == {otp: True for otp in otps}
+    responses = client.verify_batch(otps, return_response=True)
+    assert sorted(responses) == sorted(otps)
+    for otp in otps:
+        assert responses[otp]['otp'] == otp
+        assert responses[otp]['status'] == 'OK'
+
+
+def test_verify_batch_timeout_starts_when_sent(monkeypatch):
+    client = VerificationClient(['http://ykval1', 'http://ykval2'], client_id=1, http_timeout=0.3)
+
+    def fetch(url, params):
+        params = dict(params)
+        time.sleep(1 if params['otp'] == OTP else 0.05)
+        return {'otp': params['otp'], 'nonce': params['nonce'], 'status': 'OK'}
+    monkeypatch.setattr(client, '_fetch', fetch)
+    # 400 requests on the 32 workers of the batch pool take well over http_timeout
+    otps = ['idkfefrdhtru%032d' % i for i in range(200)] + [OTP]
+    results = client.verify_batch(otps)
+    assert results.pop(OTP) is None
+    assert results == {otp: True for otp in otps if otp != OTP}
+
+
+def test_verify_returns_false_without_ok(monkeypatch):
+    client = VerificationClient(['http://ykval1'], client_id=1)
+
+    def fetch(url, params):
+        params = dict(params)
+        return {'otp': params['otp'], 'nonce': params['nonce'], 'status': 'REPLAYED_OTP'}
+    monkeypatch.setattr(client, '_fetch', fetch)
+    assert client.verify(OTP) is False
+    assert client.verify(OTP, return_response=True)['status'] == 'REPLAYED_OTP'
+
+
+@pytest.mark.parametrize('fast_status, expected', [
+    ('REPLAYED_OTP', 'REPLAYED_OTP'),
+    ('BACKEND_ERROR', 'OK'),
+])
+def test_verify_does_not_wait_for_ok_after_replayed_otp(monkeypatch, fast_status, expected):
+    client = VerificationClient(['http://ykval1', 'http://ykval2'], client_id=1)
+
+    def fetch(url, params):
+        params = dict(params)
+        if url == 'http://ykval2':
+            time.sleep(0.2)
+            status = 'OK'
+        else:
+            status = fast_status
+        return {'otp': params['otp'], 'nonce': params['nonce'], 'status': status}
+    monkeypatch.setattr(client, '_fetch', fetch)
+    assert client.verify(OTP) is (expected == 'OK')
+    assert client.verify(OTP, return_response=True)['status'] == expected
+    response = asyncio.run(client.verify_async(OTP, return_response=True))
+    assert response['status'] == expected
+
+
+def test_outdated_password_hash_is_upgraded(client):
+    client.db.update_user_hash(1, sha256_crypt.using(rounds=1000).hash('0000'))
+    client.invalidate('test')
+    user = client._get_user_info('test', OTP[:12])
+    assert client._validate_password(user, '0000') is True
+    for _ in range(100):
+        if client._user_cache.get(('test', OTP[:12])) is None:
+            break
+        time.sleep(0.05)
+    assert client._user_cache.get(('test', OTP[:12])) is None
+    upgraded = client._get_user_info('test', OTP[:12]).auth
+    assert not client.pwd_context.needs_update(upgraded)
+    assert client.pwd_context.verify('0000', upgraded)
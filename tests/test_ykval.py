@@ -0,0 +1,130 @@
+import base64
+
+import pytest
+
+from yubikit.exceptions import YKValError
+from yubikit.ykval import Validator, clear_client_cache
+
+SECRET = 'EHmo8FMxuhumBlTinC4uYL0Mgwg='
+
+
+@pytest.fixture
+def validator(databases):
+    clear_client_cache()
+    yield Validator()
+    clear_client_cache()
+
+
+def test_client_apikey_is_cached(validator, monkeypatch):
+    assert validator.get_client_apikey(1) == base64.b64decode(SECRET)
+    monkeypatch.setattr(validator.db, 'get_client_data', None)
+    assert validator.get_client_apikey(1) == base64.b64decode(SECRET)
+
+
+def test_unknown_client_is_cached(validator, monkeypatch):
+    with pytest.raises(YKValError) as err:
+        validator.get_client_apikey(2)
+    assert err.value.error_code == 'NO_SUCH_CLIENT'
+    monkeypatch.setattr(validator.db, 'get_client_data', None)
+    with pytest.raises(YKValError):
+        validator.get_client_apikey(2)
+
+
+def test_enqueue_many(validator):
+    params = {'modified': 1700000000, 'otp': 'c' * 44, 'nonce': 'a' * 16,
+              'yk_publicname': 'c' * 12, 'yk_counter': 1, 'yk_use': 2, 'yk_high': 3, 'yk_low': 4}
+    servers = ['http://ykval1/sync', 'http://ykval2/sync']
+    validator.db.enqueue_many([(params, params)], servers, 'b' * 32)
+    queued = validator.db.get_queue(params['modified'], 'b' * 32)
+    assert sorted(row['server'] for row in queued) == servers
+    assert all(row['otp'] == params['otp'] for row in queued)
+    assert queued[0]['info'] == ('yk_publicname=cccccccccccc&yk_counter=1&yk_use=2&yk_high=3&yk_low=4'
+                                 '&nonce=aaaaaaaaaaaaaaaa,&local_counter=1&local_use=2')
+    validator.db.null_queue('b' * 32)
+    for server in servers:
+        validator.db.remove_from_queue(server, params['modified'], 'b' * 32)
+
+
+@pytest.mark.parametrize('otp, nonce, error', [
+    ('c' * 43 + 'x', 'a' * 16, 'BAD_OTP'),
+    ('c' * 44, 'a' * 15 + '-', 'INVALID_PARAMETER'),
+    ('c' * 44, 'a' * 15 + 'é', 'INVALID_PARAMETER'),
+])
+def test_check_parameters_rejects(validator, otp, nonce, error):
+    params = {'otp': otp, 'nonce': nonce, 'client_id': 1, 'timeout': 1, 'sync_level': 100}
+    with pytest.raises(YKValError) as err:
+        validator.check_parameters(params)
+    assert err.value.error_code == error
+
+
+def test_concurrent_otp_submission_is_rejected(validator):
+    params = {'otp': 'c' * 44, 'token_id': 'c' * 12}
+    with validator._otp_in_flight(params):
+        with pytest.raises(YKValError) as err:
+            with validator._otp_in_flight(params):
+                pass
+        assert err.value.error_code == 'REPLAYED_REQUEST'
+    with validator._otp_in_flight(params):
+        pass
+
+
+def test_validate_otp_loses_race(validator):
+    stale = validator.db.get_local_params('cccccccccccb')
+    params = dict(stale, otp='cccccccccccb' + 'c' * 32, nonce='a' * 16, modified=1, yk_counter=5, yk_use=0)
+    assert validator.db.update_db_counters(params) == 1
+    with pytest.raises(YKValError) as err:
+        validator.validate_otp(dict(params, yk_counter=3), stale)
+    assert err.value.error_code == 'REPLAYED_OTP'
+
+
+class FakeReplayCache:
+    """ The part of a Redis client used by the replay cache """
+    def __init__(self):
+        self.data = {}
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def release(self, keys, args):
+        if self.data.get(keys[0]) == args[0]:
+            del self.data[keys[0]]
+
+
+def test_failed_validation_releases_replay_cache(validator, monkeypatch):
+    cache = FakeReplayCache()
+    monkeypatch.setattr(validator, 'replay_cache', cache, raising=False)
+    monkeypatch.setattr(validator, '_release_replay', cache.release, raising=False)
+
+    def decode_otp(otp):
+        raise YKValError('BACKEND_ERROR')
+    monkeypatch.setattr(validator, 'decode_otp', decode_otp)
+    for _ in range(2):
+        with pytest.raises(YKValError) as err:
+            validator.verify('c' * 44, client_id=1, nonce='a' * 16)
+        assert err.value.error_code == 'BACKEND_ERROR'
+    assert cache.data == {}
+    # An entry recorded by another request is left alone
+    cache.data['ykval:otp:' + 'c' * 44] = 'b' * 16
+    with pytest.raises(YKValError) as err:
+        validator.verify('c' * 44, client_id=1, nonce='a' * 16)
+    assert err.value.error_code == 'REPLAYED_OTP'
+    assert cache.data == {'ykval:otp:' + 'c' * 44: 'b' * 16}
+
+
+def test_in_flight_rejection_leaves_replay_cache_alone(validator, monkeypatch):
+    cache = FakeReplayCache()
+    monkeypatch.setattr(validator, 'replay_cache', cache, raising=False)
+    monkeypatch.setattr(validator, '_release_replay', cache.release, raising=False)
+    params = {'otp': 'c' * 44, 'token_id': 'c' * 12}
+    # The first request has released its cache entry but is still in flight
+    with validator._otp_in_flight(params):
+        with pytest.raises(YKValError) as err:
+            validator.verify('c' * 44, client_id=1, nonce='a' * 16)
+        assert err.value.error_code == 'REPLAYED_REQUEST'
+    assert cache.data == {}
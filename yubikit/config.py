@@ -47,8 +47,19 @@ VALUES = [
     ('SYNC_LEVEL', 100),
     ('SYNC_POOL', []),
     ('SYNC_TIMEOUT', 3),
+    ('SYNC_POOL_SIZE', None),
     ('SYSLOG_WSGI_AUTH', True),
     ('TS_ABS_TOLERANCE', 0),
+    ('AUTH_CACHE_SIZE', 4096),
+    ('AUTH_CACHE_TTL', 30),
+    ('CRYPT_WORKERS', None),
+    ('DB_POOL_SIZE', 8),
+    ('DB_MAX_CONNECTIONS', 32),
+    ('CLIENT_CACHE_SIZE', 4096),
+    ('CLIENT_CACHE_TTL', 300),
+    ('REDIS_URL', None),
+    ('REDIS_OTP_TTL', 3600),
+    ('LOCAL_PARAMS_CACHE_TTL', 0),
 ]
 
 
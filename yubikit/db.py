@@ -5,13 +5,153 @@ ykval.db
 Database Handler & queries
 """
 
+from contextlib import contextmanager
+from functools import lru_cache
 import logging
+import queue
+import threading
 import time
 
 from .config import settings
 
 logger = logging.getLogger(__name__)
 
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+_REDIS_CLIENTS = {}
+_REDIS_CLIENTS_LOCK = threading.Lock()
+
+# Fields of the cached local params, and the ones holding integers
+LOCAL_PARAMS_FIELDS = ('active', 'modified', 'yk_publicname', 'yk_counter',
+                       'yk_use', 'yk_low', 'yk_high', 'nonce')
+LOCAL_PARAMS_INT_FIELDS = ('active', 'modified', 'yk_counter', 'yk_use', 'yk_low', 'yk_high')
+# The fields written with the counters, which must only move forward
+LOCAL_PARAMS_COUNTER_FIELDS = ('modified', 'yk_counter', 'yk_use', 'yk_low', 'yk_high', 'nonce')
+
+# Merge counters into the cached local params of a yubikey, with the same
+# "only move forward" condition update_db_counters applies in SQL.
+# KEYS[1]: cache key
+# ARGV[1]: TTL, ARGV[2]: yk_counter, ARGV[3]: yk_use, ARGV[4]: number of
+# counter fields, ARGV[5..]: field, value pairs, the counter fields first.
+# The counter fields are only overwritten if the counters are newer, the
+# other fields always are.
+MERGE_LOCAL_PARAMS_LUA = """
+local counters = redis.call('HMGET', KEYS[1], 'yk_counter', 'yk_use')
+local counter, use = tonumber(counters[1]), tonumber(counters[2])
+local new_counter, new_use = tonumber(ARGV[2]), tonumber(ARGV[3])
+local newer = counter == nil or use == nil or counter < new_counter
+    or (counter == new_counter and use < new_use)
+local last_counter = 4 + 2 * tonumber(ARGV[4])
+for i = 5, #ARGV, 2 do
+    if newer or i > last_counter then
+        redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+    else
+        redis.call('HSETNX', KEYS[1], ARGV[i], ARGV[i + 1])
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return newer and 1 or 0
+"""
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of DB-API connections
+
+    Idle connections are kept for reuse (up to maxcached), while the number
+    of connections checked out at the same time is capped by maxconnections.
+    """
+    def __init__(self, connect, maxcached=8, maxconnections=32):
+        self._connect = connect
+        self._idle = queue.LifoQueue(maxsize=maxcached)
+        self._slots = threading.BoundedSemaphore(maxconnections)
+
+    @contextmanager
+    def connection(self, fresh=False):
+        """
+        Check out a connection for the duration of the with block
+
+        Connections which raised an error are closed instead of being
+        returned to the pool, so a dead connection is never handed out twice.
+        With fresh, a new connection is opened and the idle ones are closed:
+        after a server restart or wait_timeout they are all just as dead.
+        """
+        with self._slots:
+            if fresh:
+                self.clear()
+                conn = self._connect()
+            else:
+                try:
+                    conn = self._idle.get_nowait()
+                except queue.Empty:
+                    conn = self._connect()
+            try:
+                yield conn
+            except BaseException:
+                self._close(conn)
+                raise
+            try:
+                self._idle.put_nowait(conn)
+            except queue.Full:
+                self._close(conn)
+
+    def clear(self):
+        """ Close all the idle connections """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        """ Close a connection, ignoring errors of already broken ones """
+        try:
+            conn.close()
+        except Exception as err:
+            logger.debug('Failed to close database connection: %s', err)
+
+
+def _sqlite_dict_factory(cursor, row):
+    """ sqlite3 row_factory returning the rows as dicts """
+    return dict(zip([col[0] for col in cursor.description], row))
+
+
+@lru_cache(maxsize=128)
+def _sqlite_query(query):
+    """
+    Convert the format/pyformat placeholders of a query to sqlite syntax
+
+    Memoized, the queries are constant strings so each one is only
+    converted once. sqlite3 then finds the converted text in the
+    connection's own statement cache and skips parsing it again.
+    """
+    if '%s' in query:
+        return query.replace('%s', '?')
+    if '%(' in query:
+        return query.replace('%(', ':').replace(')s', '')
+    return query
+
+
+def get_redis(url):
+    """ Return the process-wide Redis client of url, creating it on first use """
+    with _REDIS_CLIENTS_LOCK:
+        if url not in _REDIS_CLIENTS:
+            import redis
+            _REDIS_CLIENTS[url] = redis.Redis.from_url(url, decode_responses=True)
+        return _REDIS_CLIENTS[url]
+
+
+def get_pool(db, connect):
+    """ Return the process-wide connection pool of db, creating it with connect on first use """
+    with _POOLS_LOCK:
+        if db not in _POOLS:
+            _POOLS[db] = ConnectionPool(connect,
+                                        maxcached=settings['DB_POOL_SIZE'],
+                                        maxconnections=settings['DB_MAX_CONNECTIONS'])
+        return _POOLS[db]
+
 
 class DBHandler:
     """ Database handler wrapper """
@@ -29,60 +169,88 @@ class DBHandler:
         else:
             raise ValueError('Invalid Database configuration')
         self.dbdriver = dbdriver
-        self._connect()
+        self.pool = get_pool(db, self._connect)
+        # Optional Redis cache of the ykval local params
+        self.cache = None
+        if settings['REDIS_URL'] and settings['LOCAL_PARAMS_CACHE_TTL']:
+            self.cache = get_redis(settings['REDIS_URL'])
+            self._merge_local_params = self.cache.register_script(MERGE_LOCAL_PARAMS_LUA)
 
     def _connect(self):
-        """ Connect to the database """
+        """
+        Open a new connection to the database
+
+        The connections are set up to return rows as dicts, so the
+        fetch helpers don't have to build them from cursor.description.
+        """
         if self.settings.get('ENGINE', 'mysql') == 'mysql':
-            self._db = self.dbdriver.connect(self.settings['HOST'],
-                                             self.settings['USER'],
-                                             self.settings['PASSWORD'],
-                                             self.settings['NAME'],
-                                             int(self.settings.get('PORT', 3306)))
+            from MySQLdb.cursors import DictCursor
+            return self.dbdriver.connect(self.settings['HOST'],
+                                         self.settings['USER'],
+                                         self.settings['PASSWORD'],
+                                         self.settings['NAME'],
+                                         int(self.settings.get('PORT', 3306)),
+                                         cursorclass=DictCursor)
         elif self.settings['ENGINE'] == 'postgres':
-            self._db = self.dbdriver.connect(database=self.settings['NAME'],
-                                             user=self.settings['USER'],
-                                             password=self.settings['PASSWORD'],
-                                             host=self.settings['HOST'])
+            from psycopg2.extras import RealDictCursor
+            return self.dbdriver.connect(database=self.settings['NAME'],
+                                         user=self.settings['USER'],
+                                         password=self.settings['PASSWORD'],
+                                         host=self.settings['HOST'],
+                                         cursor_factory=RealDictCursor)
         elif self.settings['ENGINE'] == 'sqlite':
-            self._db = self.dbdriver.connect(self.settings['NAME'])
-        self.cursor = self._db.cursor()
-
-    def _execute(self, query, params=None, retry=False):
-        """ Abstract the cursor execute function to handle sqlite syntax """
-        if self.settings.get('ENGINE') == 'sqlite':
-            if '%s' in query and params:
-                query = query.replace('%s', '?')
-            elif '%(' in query and params:
-                query = query.replace('%(', ':').replace(')s', '')
+            # Pooled connections are handed out to any thread
+            conn = self.dbdriver.connect(self.settings['NAME'], check_same_thread=False)
+            conn.row_factory = _sqlite_dict_factory
+            return conn
+
+    def _execute(self, query, params=None, fetch=None, retry=False, many=False):
+        """
+        Abstract the cursor execute function to handle sqlite syntax
+
+        A pooled connection is checked out for the query, the retry after an
+        OperationalError runs on a fresh one. If fetch is given
+        it's called with the cursor and its result is returned, otherwise the
+        number of affected rows is returned. With many, params is a sequence
+        of parameter sets passed to cursor.executemany.
+        """
+        if self.settings.get('ENGINE') == 'sqlite' and params:
+            query = _sqlite_query(query)
         if logger.getEffectiveLevel() == logging.DEBUG:
             _query = ' '.join([x.strip() for x in query.split()])
             logger.debug('QUERY: %s PARAMS: %s', _query, params)
         try:
-            rowcount = self.cursor.execute(query, params)
-            self._db.commit()
-            return rowcount
+            with self.pool.connection(fresh=retry) as conn:
+                cursor = conn.cursor()
+                try:
+                    if many:
+                        cursor.executemany(query, params)
+                    else:
+                        cursor.execute(query, params or ())
+                    result = fetch(cursor) if fetch else cursor.rowcount
+                    conn.commit()
+                finally:
+                    cursor.close()
+                return result
         except (AttributeError, self.dbdriver.OperationalError) as err:
             if not retry:
                 logger.debug('Database reconnect due to error: %s', err)
-                self._connect()
-                return self._execute(query, params, retry=True)
+                return self._execute(query, params, fetch, retry=True, many=many)
             else:
                 raise
         except Exception as err:
             logger.exception('Database error: %s', err)
             raise
 
-    def _dictfetchall(self):
+    @staticmethod
+    def _dictfetchall(cursor):
         """ Wrapper to return DB results in dict format """
-        return [dict(zip([col[0] for col in self.cursor.description], row)) for row in self.cursor.fetchall()]
+        return list(cursor.fetchall())
 
-    def _dictfetchone(self):
-        """ Wrapper to return DB results in dict format """
-        data = self._dictfetchall()
-        if data:
-            return data[0]
-        return {}
+    @staticmethod
+    def _dictfetchone(cursor):
+        """ Wrapper to return the first DB result in dict format, {} if there is none """
+        return cursor.fetchone() or {}
 
     #################
     # YKAUTH QUERIES
@@ -96,8 +264,7 @@ class DBHandler:
                           users.auth AS users_auth
                      FROM users
                     WHERE users.name = %s"""
-        self._execute(query, (username,))
-        return self._dictfetchone()
+        return self._execute(query, (username,), fetch=self._dictfetchone)
 
     def get_token(self, user_id, token_id):
         """
@@ -112,8 +279,43 @@ class DBHandler:
                        ON user_yubikeys.yubikey_id = yubikeys.id
                     WHERE user_yubikeys.user_id = %s
                       AND yubikeys.prefix = %s"""
-        self._execute(query, (user_id, token_id))
-        return self._dictfetchone()
+        return self._execute(query, (user_id, token_id), fetch=self._dictfetchone)
+
+    def get_user_with_token(self, username, token_id):
+        """
+        Read user information and the user's token in a single query for Yubiauth
+
+        The yubikeys_* columns are NULL when the token is not associated with the user
+        """
+        query = """SELECT users.attribute_association_id AS users_attribute_association_id,
+                          users.id AS users_id, users.name AS users_name,
+                          users.auth AS users_auth,
+                          tokens.yubikeys_attribute_association_id AS yubikeys_attribute_association_id,
+                          tokens.yubikeys_id AS yubikeys_id,
+                          tokens.yubikeys_prefix AS yubikeys_prefix,
+                          tokens.yubikeys_enabled AS yubikeys_enabled
+                     FROM users
+                LEFT JOIN (SELECT user_yubikeys.user_id AS user_id,
+                                  yubikeys.attribute_association_id AS yubikeys_attribute_association_id,
+                                  yubikeys.id AS yubikeys_id,
+                                  yubikeys.prefix AS yubikeys_prefix,
+                                  yubikeys.enabled AS yubikeys_enabled
+                             FROM yubikeys
+                       INNER JOIN user_yubikeys
+                               ON user_yubikeys.yubikey_id = yubikeys.id
+                            WHERE yubikeys.prefix = %s) tokens
+                       ON tokens.user_id = users.id
+                    WHERE users.name = %s"""
+        return self._execute(query, (token_id, username), fetch=self._dictfetchone)
+
+    def update_user_hash(self, user_id, password_hash):
+        """
+        Replace the password hash of a user for Yubiauth
+        """
+        query = """UPDATE users
+                      SET auth = %s
+                    WHERE id = %s"""
+        self._execute(query, (password_hash, user_id))
 
     #########################
     # YKVAL / YKSYNC QUERIES
@@ -125,11 +327,14 @@ class DBHandler:
                      FROM clients
                     WHERE active = 1
                       AND id = %s"""
-        self._execute(query, (client_id,))
-        return self._dictfetchone()
+        return self._execute(query, (client_id,), fetch=self._dictfetchone)
 
     def get_local_params(self, yk_publicname):
-        """ Get yubikey parameters from DB """
+        """ Get yubikey parameters from the cache, or from DB """
+        local_params = self._get_cached_local_params(yk_publicname)
+        if local_params:
+            logger.debug('[%s] Auth data (cached): %s', yk_publicname, local_params)
+            return local_params
         query = """SELECT active,
                           modified,
                           yk_publicname,
@@ -140,8 +345,7 @@ class DBHandler:
                           nonce
                      FROM yubikeys
                     WHERE yk_publicname = %s"""
-        self._execute(query, (yk_publicname,))
-        local_params = self._dictfetchone()
+        local_params = self._execute(query, (yk_publicname,), fetch=self._dictfetchone)
         if not local_params:
             local_params = {
                 'active': '1',
@@ -157,9 +361,55 @@ class DBHandler:
             # Key was missing in DB, adding it
             self.add_new_identity(local_params)
             logger.warning('[%s] Discovered new identity, creating yubikey', yk_publicname)
+        self._cache_local_params(local_params)
         logger.debug('[%s] Auth data: %s', yk_publicname, local_params)
         return local_params
 
+    def _get_cached_local_params(self, yk_publicname):
+        """ Read yubikey parameters from the cache, None if they aren't (all) cached """
+        if self.cache is None:
+            return None
+        from redis import RedisError
+        try:
+            cached = self.cache.hgetall('ykval:yk:%s' % yk_publicname)
+        except RedisError as err:
+            logger.warning('[%s] Local params cache unavailable: %s', yk_publicname, err)
+            return None
+        if not cached or any(field not in cached for field in LOCAL_PARAMS_FIELDS):
+            return None
+        for field in LOCAL_PARAMS_INT_FIELDS:
+            cached[field] = int(cached[field])
+        return cached
+
+    def _cache_local_params(self, params):
+        """
+        Merge yubikey parameters into the cache
+
+        The cached counters only move forward, the active flag is
+        overwritten when params come from a DB read. If the cache can't be
+        updated the entry is dropped, so it never serves stale counters.
+        """
+        if self.cache is None:
+            return
+        from redis import RedisError
+        key = 'ykval:yk:%s' % params['yk_publicname']
+        args = [settings['LOCAL_PARAMS_CACHE_TTL'], params['yk_counter'], params['yk_use'],
+                len(LOCAL_PARAMS_COUNTER_FIELDS)]
+        for field in LOCAL_PARAMS_COUNTER_FIELDS:
+            args.extend((field, params[field]))
+        # Read from the DB, refresh the flag of a deactivated key
+        if 'active' in params:
+            args.extend(('active', int(bool(params['active'])), 'yk_publicname', params['yk_publicname']))
+        try:
+            self._merge_local_params(keys=[key], args=args)
+        except RedisError as err:
+            logger.warning('[%s] Failed to update local params cache: %s',
+                           params['yk_publicname'], err)
+            try:
+                self.cache.delete(key)
+            except RedisError:
+                pass
+
     def add_new_identity(self, identity):
         """ Create new key identity """
         query = """INSERT INTO yubikeys (
@@ -196,8 +446,7 @@ class DBHandler:
                      FROM queue
                     WHERE modified=%s
                       AND server_nonce = %s"""
-        self._execute(query, (modified, server_nonce))
-        return self._dictfetchall()
+        return self._execute(query, (modified, server_nonce), fetch=self._dictfetchall)
 
     def read_queue(self):
         """
@@ -209,8 +458,7 @@ class DBHandler:
                           info,
                           server_nonce
                      FROM queue"""
-        self._execute(query)
-        return self._dictfetchall()
+        return self._execute(query, fetch=self._dictfetchall)
 
     def remove_from_queue(self, server, modified, server_nonce):
         """
@@ -233,7 +481,13 @@ class DBHandler:
         self._execute(query, (server_nonce,))
 
     def update_db_counters(self, params):
-        """ Update table with new counter values """
+        """
+        Update table with new counter values
+
+        Returns:
+            number of updated rows, 0 if the stored counters are not lower
+            than the new ones (e.g. a concurrent request got there first)
+        """
         query = """UPDATE yubikeys
                       SET modified = %(modified)s,
                           yk_counter = %(yk_counter)s,
@@ -245,16 +499,29 @@ class DBHandler:
                       AND (yk_counter < %(yk_counter)s
                        OR (yk_counter = %(yk_counter)s
                       AND yk_use < %(yk_use)s))"""
-        self._execute(query, params)
+        updated = self._execute(query, params)
+        if updated:
+            self._cache_local_params(params)
+        return updated
 
     def enqueue(self, otp_params, local_params, server, server_nonce):
         """
         Insert new params into database queue table
         """
-        info = 'yk_publicname=%(yk_publicname)s&yk_counter=%(yk_counter)s' % otp_params
-        info += '&yk_use=%(yk_use)s&yk_high=%(yk_high)s&yk_low=%(yk_low)s' % otp_params
-        info += '&nonce=%(nonce)s' % otp_params
-        info += ',&local_counter=%(yk_counter)s&local_use=%(yk_use)s' % local_params
+        self.enqueue_many([(otp_params, local_params)], [server], server_nonce)
+
+    def enqueue_many(self, params, servers, server_nonce):
+        """
+        Insert new params into database queue table for each of servers
+
+        Args:
+            params: list of (otp_params, local_params) tuples
+            servers: sync servers to queue every params for
+            server_nonce
+
+        The rows are inserted with a single executemany, the info column
+        of each params is built once as it's the same for every server.
+        """
         query = """INSERT INTO queue (
                         queued,
                         modified,
@@ -263,20 +530,43 @@ class DBHandler:
                         server_nonce,
                         info
                     ) VALUES (%s, %s, %s, %s, %s, %s)"""
-        self._execute(query, (int(time.time()), otp_params['modified'],
-                              otp_params['otp'], server, server_nonce, info))
+        queued = int(time.time())
+        rows = []
+        for otp_params, local_params in params:
+            info = ('yk_publicname=%(yk_publicname)s&yk_counter=%(yk_counter)s'
+                    '&yk_use=%(yk_use)s&yk_high=%(yk_high)s&yk_low=%(yk_low)s'
+                    '&nonce=%(nonce)s,&local_counter=%(local_counter)s&local_use=%(local_use)s') % {
+                        **otp_params,
+                        'local_counter': local_params['yk_counter'],
+                        'local_use': local_params['yk_use'],
+                    }
+            rows.extend((queued, otp_params['modified'], otp_params['otp'], server, server_nonce, info)
+                        for server in servers)
+        if rows:
+            self._execute(query, rows, many=True)
+
+    def get_keys_local_params(self, yk_publicname):
+        """
+        Get the yubikey parameters of all active keys (or of a single one) from DB
 
-    def get_keys(self, yk_publicname):
-        """ Get all keys from DB """
-        query = """SELECT yk_publicname
+        yk_publicname is either a public name or 'all'. One query instead of
+        a get_local_params per key.
+        """
+        query = """SELECT active,
+                          modified,
+                          yk_publicname,
+                          yk_counter,
+                          yk_use,
+                          yk_low,
+                          yk_high,
+                          nonce
                      FROM yubikeys
                     WHERE active = 1"""
         params = None
         if yk_publicname != 'all':
             query += ' AND yk_publicname = %s'
             params = (yk_publicname,)
-        self._execute(query, params)
-        return self._dictfetchall()
+        return self._execute(query, params, fetch=self._dictfetchall)
 
     ################
     # YKKSM QUERIES
@@ -290,5 +580,4 @@ class DBHandler:
                      FROM yubikeys
                     WHERE (active = '1' OR active = 'true')
                       AND publicname = %s"""
-        self._execute(query, (public_id,))
-        return self._dictfetchone()
+        return self._execute(query, (public_id,), fetch=self._dictfetchone)
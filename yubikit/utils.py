@@ -7,14 +7,21 @@ Helper utilities for Yubikey Validator (YK-VAL)
 
 import base64
 from binascii import hexlify, unhexlify
+from collections import OrderedDict
 from urllib.parse import parse_qs
 from Crypto.Cipher import AES
 from datetime import datetime
 import hashlib
 import hmac
 import logging
-from random import getrandbits
+from operator import itemgetter
 import re
+import secrets
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
 
 logger = logging.getLogger(__name__)
 
@@ -134,29 +141,129 @@ def check_crc(token):
 def sign(data, apikey):
     """
     Sign a http query string in the array of key-value pairs
+    (a dict or an iterable of (key, value) tuples)
     return b64 encoded hmac hash
 
+    apikey is either the raw key or an HMAC-SHA-1 object already keyed with
+    it, which is copied for every signature.
+
     https://github.com/Yubico/yubikey-val/blob/master/doc/Validation_Protocol_V2.0.adoc#generating-signatures
+    >>> key = base64.b64decode('c2VjcmV0a2V5cw==')
+    >>> sign([('otp', 'cccc'), ('id', 1)], key) == sign({'id': 1, 'otp': 'cccc'}, key)
+    True
+    >>> sign({'id': 1}, hmac.new(key, digestmod=hashlib.sha1)) == sign({'id': 1}, key)
+    True
     """
+    items = data.items() if isinstance(data, dict) else data
     # Alphabetically sort the set of key/value pairs by key order.
-    keys = sorted(data.keys())
+    items = sorted(items, key=itemgetter(0))
     # Construct a single line with each ordered key/value pair concatenated using &,
     # and each key and value contatenated with =. Do not add any linebreaks.
     # Do not add whitespace. For example: a=2&b=1&c=3.
-    query_string = '&'.join(['%s=%s' % (k, data[k]) for k in keys])
+    query_string = '&'.join(['%s=%s' % (k, v) for k, v in items])
     # Apply the HMAC-SHA-1 algorithm on the line as an octet string using the API key as key
-    signature = hmac.new(apikey, query_string.encode(), hashlib.sha1).digest()
+    # (copying a pre-keyed HMAC skips the key setup)
+    if isinstance(apikey, hmac.HMAC):
+        mac = apikey.copy()
+    else:
+        mac = hmac.new(apikey, digestmod=hashlib.sha1)
+    mac.update(query_string.encode())
+    signature = mac.digest()
     # Base 64 encode the resulting value according to RFC 4648
     signature = base64.b64encode(signature).decode()
     logger.debug('Signed data: %s (H=%s)', query_string, signature)
     return signature
 
 
+def check_signature(data, signature, apikey):
+    """
+    Check the b64 encoded hmac signature of the key-value pairs in data
+
+    Signatures must always be compared with hmac.compare_digest, never with ==,
+    which returns at the first differing byte and leaks the matching prefix length.
+    """
+    return hmac.compare_digest(sign(data, apikey).encode(), str(signature).encode())
+
+
 def generate_nonce():
     """
-    Generate a random nonce
+    Generate a random nonce of 32 hex characters
+    """
+    return secrets.token_hex(16)
+
+
+def http_session(pool_connections=10, pool_maxsize=10, max_retries=0):
+    """
+    Build a requests Session with a pooled HTTPAdapter mounted for both
+    http:// and https://, so keep-alive connections are reused across calls
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections,
+                          pool_maxsize=pool_maxsize,
+                          max_retries=max_retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class TTLCache:
+    """
+    Thread-safe LRU mapping with a bounded size whose entries expire ttl seconds after they were set
+
+    >>> cache = TTLCache(maxsize=2, ttl=30)
+    >>> cache.set('a', 1)
+    >>> cache.set('b', 2)
+    >>> cache.set('c', 3)
+    >>> cache.get('a') is None, cache.get('c')
+    (True, 3)
     """
-    return hex(getrandbits(128))[2:-1]
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        """ Return the value for key if it's cached and not expired """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires, value = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """ Cache value for key, evicting the least recently used entries when full """
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """ Remove key from the cache and return its value """
+        with self._lock:
+            item = self._data.pop(key, None)
+            return default if item is None else item[1]
+
+    def keys(self):
+        """ Return a snapshot of the cached keys """
+        with self._lock:
+            return list(self._data)
+
+    def clear(self):
+        """ Empty the cache """
+        with self._lock:
+            self._data.clear()
+
+
+# (yk_counter, yk_use) tuple of a set of parameters, tuples compare
+# lexicographically just like the counters do
+_counters = itemgetter('yk_counter', 'yk_use')
 
 
 def counters_eq(params1, params2):
@@ -170,10 +277,7 @@ def counters_eq(params1, params2):
     >>> counters_eq(p1, p2)
     False
     """
-    return (
-        params1['yk_counter'] == params2['yk_counter']
-        and params1['yk_use'] == params2['yk_use']
-    )
+    return _counters(params1) == _counters(params2)
 
 
 def counters_gt(params1, params2):
@@ -190,13 +294,7 @@ def counters_gt(params1, params2):
     >>> counters_gt(p1, p2)
     True
     """
-    return (
-        params1['yk_counter'] > params2['yk_counter']
-        or (
-            params1['yk_counter'] == params2['yk_counter']
-            and params1['yk_use'] > params2['yk_use']
-        )
-    )
+    return _counters(params1) > _counters(params2)
 
 
 def counters_gte(params1, params2):
@@ -213,13 +311,7 @@ def counters_gte(params1, params2):
     >>> counters_gte(p1, p2)
     True
     """
-    return (
-        params1['yk_counter'] > params2['yk_counter']
-        or (
-            params1['yk_counter'] == params2['yk_counter']
-            and params1['yk_use'] >= params2['yk_use']
-        )
-    )
+    return _counters(params1) >= _counters(params2)
 
 
 SYNC_RESPONSE_CHECKS = {
@@ -247,6 +339,16 @@ def parse_sync_response(sync_response):
     return params
 
 
+def parse_response(response):
+    """
+    Parse a key=value per line server response into a dict
+    >>> r = parse_response('h=abc=\\r\\nt=2015-04-14T20:07:20Z5261\\r\\nstatus=OK\\r\\n\\r\\n')
+    >>> r == {'h': 'abc=', 't': '2015-04-14T20:07:20Z5261', 'status': 'OK'}
+    True
+    """
+    return dict(line.split('=', 1) for line in response.splitlines() if '=' in line)
+
+
 def wsgi_response(resp, start_response, apikey=b'', extra=None, status=200):
     """ Function to return a proper WSGI response """
     # yubikey-val's getUTCTimeStamp() function...
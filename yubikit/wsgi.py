@@ -22,6 +22,7 @@ from yubikit.exceptions import (
     YKKSMError,
 )
 from yubikit.utils import (
+    check_signature,
     parse_querystring,
     wsgi_response,
     sign,
@@ -184,10 +185,9 @@ def verify(environ, start_response):
         validator = Validator()
         apikey = validator.get_client_apikey(params.get('id'))
         client_signature = params.pop('h')
-        server_signature = sign(params, apikey)
-        if client_signature != server_signature:
+        if not check_signature(params, client_signature, apikey):
             logger.error('[%s] Client hmac=%s != Server hmac=%s',
-                         public_id, client_signature, server_signature)
+                         public_id, client_signature, sign(params, apikey))
             raise YKValError('BAD_SIGNATURE')
         for old_key, new_key in PARAM_MAP.items():
             if old_key in params:
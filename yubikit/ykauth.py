@@ -5,37 +5,126 @@ yubikit.ykauth
 Python Yubikey Stack - Authentication module
 """
 
-import base64
+import asyncio
+from binascii import a2b_base64
+from collections import namedtuple
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+    as_completed,
+)
+import hashlib
+import hmac
+from functools import lru_cache
 import logging
+import threading
+import time
 import urllib
 
 from passlib.context import CryptContext
 import requests
+from requests.adapters import Retry
 
 from .config import (
     settings,
     TOKEN_LEN,
+    OTP_MAX_LEN,
 )
 from .db import DBHandler
 from .exceptions import YKAuthError
 from .utils import (
+    MODHEX_CHARS,
+    check_signature,
     sign,
     generate_nonce,
+    http_session,
+    parse_response,
+    TTLCache,
 )
 
 logger = logging.getLogger(__name__)
 
+# CryptContext of a password worker process, built on its first task
+_WORKER_PWD_CONTEXT = None
+
+# Statuses of a verification server which don't settle the OTP: it was
+# synced from another server, or that server is broken. verify waits for
+# the other servers instead.
+RETRY_STATUSES = ('REPLAYED_REQUEST', 'BACKEND_ERROR')
+
+# User and token rows of the authentication DB, token is None when the
+# token is not associated with the user
+User = namedtuple('User', ['id', 'name', 'auth', 'attr_id', 'token'])
+Token = namedtuple('Token', ['id', 'prefix', 'enabled', 'attr_id'])
+
+
+@lru_cache(maxsize=64)
+def _decode_key(apikey):
+    """ Decode a base64 API key, memoized as many clients share the same key """
+    return a2b_base64(apikey)
+
+
+def _verify_password(password, password_hash, crypt_context):
+    """
+    Run CryptContext.verify_and_update in a password worker process
+
+    Module level, so it can be pickled to the ProcessPoolExecutor.
+
+    Returns:
+        (valid, new_hash) tuple
+    """
+    global _WORKER_PWD_CONTEXT
+    if _WORKER_PWD_CONTEXT is None:
+        _WORKER_PWD_CONTEXT = CryptContext(**crypt_context)
+    return _WORKER_PWD_CONTEXT.verify_and_update(password, password_hash)
+
 
 class VerificationClient:
     """ Verification Client """
-    def __init__(self, urls, client_id=None, apikey=None):
+    # HTTP session shared by every VerificationClient, so keep-alive
+    # connections to the validation servers survive across instances
+    _shared_session = None
+    _shared_session_lock = threading.Lock()
+    # Thread pool shared by every VerificationClient for verify_batch
+    _batch_executor = None
+    _batch_executor_lock = threading.Lock()
+
+    def __init__(self, urls, client_id=None, apikey=None, http_timeout=10):
         self.urls = urls
         self.client_id = client_id
-        self.apikey = base64.b64decode(apikey)
+        self.apikey = _decode_key(apikey) if apikey else b''
+        # Keyed once, every signature works on a copy of it
+        self._hmac = hmac.new(self.apikey, digestmod=hashlib.sha1) if self.apikey else None
+        self.http_timeout = http_timeout
+        self._session = self._get_session(len(urls))
+        self._executor = ThreadPoolExecutor(max_workers=max(len(urls), 1))
 
-    def generate_query(self, otp, nonce, timestamp=False, timeout=None,
-                       sync_level=None):
-        """ Generate query """
+    @classmethod
+    def _get_session(cls, pool_connections):
+        """ Return the shared HTTP session, creating it on first use """
+        with cls._shared_session_lock:
+            if cls._shared_session is None:
+                # Only retry on connection errors: a request that reached
+                # the server may have consumed the OTP already.
+                retries = Retry(total=2, read=False, backoff_factor=0.1)
+                cls._shared_session = http_session(pool_connections=max(pool_connections, 1),
+                                                   pool_maxsize=32,
+                                                   max_retries=retries)
+            return cls._shared_session
+
+    @classmethod
+    def _get_batch_executor(cls):
+        """ Return the thread pool of verify_batch, creating it on first use """
+        with cls._batch_executor_lock:
+            if cls._batch_executor is None:
+                # As many workers as the session keeps connections per server
+                cls._batch_executor = ThreadPoolExecutor(max_workers=32)
+            return cls._batch_executor
+
+    def generate_params(self, otp, nonce, timestamp=False, timeout=None,
+                        sync_level=None):
+        """ Generate the (signed) list of request parameters """
         data = [('id', self.client_id),
                 ('otp', otp),
                 ('nonce', nonce)]
@@ -48,64 +137,353 @@ class VerificationClient:
         if timeout:
             data.append(('timeout', timeout))
 
-        query_string = urllib.parse.urlencode(data)
         if self.apikey:
-            signature = sign(dict(data), self.apikey)
-            query_string += '&h=%s' % (signature.replace('+', '%B'))
-        return query_string
+            data.append(('h', sign(data, self._hmac)))
+        return data
+
+    def generate_query(self, otp, nonce, timestamp=False, timeout=None,
+                       sync_level=None):
+        """ Generate query """
+        return urllib.parse.urlencode(self.generate_params(otp, nonce, timestamp=timestamp,
+                                                           timeout=timeout,
+                                                           sync_level=sync_level))
+
+    def _check_response_signature(self, response):
+        """
+        Check the h= signature of a verification server response
+
+        The comparison is done in constant time by utils.check_signature,
+        don't replace it with a plain == on the signature strings.
+        """
+        data = {key: val for key, val in response.items() if key != 'h'}
+        return check_signature(data, response.get('h', ''), self._hmac)
+
+    def _fetch(self, url, params):
+        """ Query a single verification server and parse its response """
+        req = self._session.get(url, params=params, timeout=self.http_timeout)
+        return parse_response(req.text)
+
+    def _valid_response(self, url, response, otp, nonce):
+        """ Check that a response is signed by the server and answers our request """
+        if self.apikey and not self._check_response_signature(response):
+            logger.error('[%s] Invalid response signature from %s', otp[:-TOKEN_LEN], url)
+            return False
+        if response.get('otp') != otp or response.get('nonce') != nonce:
+            logger.error('[%s] OTP or nonce mismatch in response of %s: %s',
+                         otp[:-TOKEN_LEN], url, response)
+            return False
+        logger.debug('[%s] %s responded with status %s',
+                     otp[:-TOKEN_LEN], url, response.get('status'))
+        return True
 
     def verify(self, otp, timestamp=False, sl=None, timeout=None,
                return_response=False):
-        """ Make a HTTP call to the Yubikey Verification servers """
+        """
+        Make a HTTP call to the Yubikey Verification servers
+
+        The request is sent to every server in self.urls concurrently and
+        the first correctly signed response wins, the remaining requests
+        are cancelled. A REPLAYED_REQUEST (that server already saw this
+        request from another one) or a BACKEND_ERROR doesn't settle the
+        OTP, so we keep waiting for the others.
+
+        Returns:
+            True if the winning response has status=OK, False otherwise.
+            With return_response the response dict is returned instead:
+            the winning one, else the last REPLAYED_REQUEST or BACKEND_ERROR
+            received (None if none of the servers answered).
+        """
         nonce = generate_nonce()
-        query = self.generate_query(otp, nonce, timestamp=timestamp,
-                                    timeout=timeout, sync_level=sl)
-        req = requests.get(self.urls[0] + '?' + query)
-        print(req.text)
+        params = self.generate_params(otp, nonce, timestamp=timestamp,
+                                      timeout=timeout, sync_level=sl)
+        futures = {self._executor.submit(self._fetch, url, params): url for url in self.urls}
+        response = self._first_response(otp, nonce, futures, time.monotonic() + self.http_timeout)
+        return self._verify_result(response, return_response)
+
+    @staticmethod
+    def _verify_result(response, return_response):
+        """ Return value of the verify methods for response """
+        if return_response:
+            return response
+        return response is not None and response.get('status') == 'OK'
+
+    def _pick_response(self, response, future, url, otp, nonce):
+        """
+        Weigh the completed request future of url against the response kept so far
+
+        Returns:
+            (response, final) tuple: the response to keep, and whether it
+            settles the OTP so the other servers needn't be waited for
+        """
+        try:
+            resp = future.result()
+        except requests.RequestException as err:
+            logger.warning('Failed to retrieve %s: %s', url, err)
+            return response, False
+        if not self._valid_response(url, resp, otp, nonce):
+            return response, False
+        return resp, resp.get('status') not in RETRY_STATUSES
+
+    def _first_response(self, otp, nonce, futures, deadline):
+        """
+        Return the first valid response of futures whose status isn't in RETRY_STATUSES
+
+        Falls back to the last valid response (or None), the futures still
+        pending are cancelled.
+        """
+        response = None
+        try:
+            for future in as_completed(futures, timeout=max(deadline - time.monotonic(), 0)):
+                response, final = self._pick_response(response, future, futures[future], otp, nonce)
+                if final:
+                    break
+        except FutureTimeoutError:
+            logger.warning('[%s] Timed out waiting for verification servers', otp[:-TOKEN_LEN])
+        finally:
+            for future in futures:
+                future.cancel()
+        return response
+
+    def verify_batch(self, otps, timestamp=False, sl=None, timeout=None,
+                     return_response=False):
+        """
+        Verify many OTPs at once
+
+        Every request of the batch is sent concurrently over the pooled
+        keep-alive connections of the shared session, so the round-trips
+        overlap instead of adding up. Each OTP is still a request of its
+        own, with its own nonce and signature. The requests queue up on
+        the shared thread pool, so the timeout of an OTP only starts once
+        its requests are actually sent.
+
+        Returns:
+            dict of otp: result, as verify() would have returned it, except
+            that the OTPs no server answered in time map to None rather
+            than False
+        """
+        executor = self._get_batch_executor()
+        batch = []
+        for otp in otps:
+            nonce = generate_nonce()
+            params = self.generate_params(otp, nonce, timestamp=timestamp,
+                                          timeout=timeout, sync_level=sl)
+            started = threading.Semaphore(0)
+            futures = {executor.submit(self._fetch_started, started, url, params): url
+                       for url in self.urls}
+            batch.append((otp, nonce, started, futures))
+        results = {}
+        for otp, nonce, started, futures in batch:
+            for _ in futures:
+                started.acquire()
+            response = self._first_response(otp, nonce, futures, time.monotonic() + self.http_timeout)
+            results[otp] = None if response is None else self._verify_result(response, return_response)
+        return results
+
+    def _fetch_started(self, started, url, params):
+        """ _fetch for verify_batch, releasing started once the request leaves the queue """
+        started.release()
+        return self._fetch(url, params)
+
+    async def verify_async(self, otp, timestamp=False, sl=None, timeout=None,
+                           return_response=False):
+        """
+        Coroutine version of verify()
+
+        The HTTP calls still run on the client's thread pool, but the
+        event loop is not blocked while waiting for the responses.
+        """
+        loop = asyncio.get_running_loop()
+        nonce = generate_nonce()
+        params = self.generate_params(otp, nonce, timestamp=timestamp,
+                                      timeout=timeout, sync_level=sl)
+        futures = {asyncio.wrap_future(self._executor.submit(self._fetch, url, params)): url
+                   for url in self.urls}
+        response = None
+        pending = set(futures)
+        deadline = loop.time() + self.http_timeout
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=deadline - loop.time(),
+                                                   return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    logger.warning('[%s] Timed out waiting for verification servers', otp[:-TOKEN_LEN])
+                    break
+                for future in done:
+                    response, final = self._pick_response(response, future, futures[future],
+                                                          otp, nonce)
+                    if final:
+                        return self._verify_result(response, return_response)
+        finally:
+            for future in pending:
+                future.cancel()
+        return self._verify_result(response, return_response)
 
 
 class Client:
     """ Authentication Client """
+    # Process pool shared by every Client to hash passwords outside of
+    # the GIL in authenticate_async, created on first use
+    _password_pool = None
+    _password_pool_lock = threading.Lock()
+    # Thread pool shared by every Client for the fire-and-forget DB writes
+    _bg_executor = None
+    _bg_executor_lock = threading.Lock()
+    # Objects which are expensive to build, shared by every Client
+    _pwd_context_singleton = None
+    _dummy_hash_singleton = None
+    _singleton_lock = threading.Lock()
+    _ykval_client_singleton = None
+    _ykval_client_lock = threading.Lock()
+
     def __init__(self):
         self.db = DBHandler(db='yubiauth')
-        self.pwd_context = CryptContext(**settings['CRYPT_CONTEXT'])
-        if settings['USE_NATIVE_YKVAL']:
-            # Native verify
-            from .ykval import Validator
-            self.ykval_client = Validator()
-        else:
-            # Using yubico_client to verify against remote server
-            from yubico_client import Yubico
-            self.ykval_client = Yubico(settings['YKVAL_CLIENT_ID'],
-                                       settings['YKVAL_CLIENT_SECRET'],
-                                       api_urls=settings['YKVAL_SERVERS'])
-
-    def _get_user_info(self, username):
-        """
-        Get user from DB
+        self.pwd_context, self._dummy_hash = self._get_pwd_context()
+        # Short lived cache of the user and token lookups. Keep the TTL
+        # short, it bounds how long a password change or disabled token
+        # can go unnoticed.
+        self._user_cache = TTLCache(settings['AUTH_CACHE_SIZE'], settings['AUTH_CACHE_TTL'])
+        self.ykval_client = self._get_ykval_client()
+
+    @classmethod
+    def _get_pwd_context(cls):
+        """ Return the shared CryptContext and dummy hash, building them on first use """
+        with cls._singleton_lock:
+            if cls._pwd_context_singleton is None:
+                cls._pwd_context_singleton = CryptContext(**settings['CRYPT_CONTEXT'])
+                # Hash verified on the failure paths which never reach the password
+                # check, so unknown users and tokens cost the same as a bad password
+                cls._dummy_hash_singleton = cls._pwd_context_singleton.hash('dummy')
+            return cls._pwd_context_singleton, cls._dummy_hash_singleton
+
+    @classmethod
+    def _get_ykval_client(cls):
+        """ Return the shared OTP validation client, building it on first use """
+        with cls._ykval_client_lock:
+            if cls._ykval_client_singleton is None:
+                if settings['USE_NATIVE_YKVAL']:
+                    # Native verify
+                    from .ykval import Validator
+                    cls._ykval_client_singleton = Validator()
+                else:
+                    # Using yubico_client to verify against remote server
+                    from yubico_client import Yubico
+                    cls._ykval_client_singleton = Yubico(settings['YKVAL_CLIENT_ID'],
+                                                         settings['YKVAL_CLIENT_SECRET'],
+                                                         api_urls=settings['YKVAL_SERVERS'])
+            return cls._ykval_client_singleton
+
+    def invalidate(self, username):
+        """
+        Drop the cached user and token data of username
+
+        Has to be called whenever the user's password or tokens are changed.
+        """
+        for key in self._user_cache.keys():
+            if key[0] == username:
+                self._user_cache.pop(key)
+
+    @classmethod
+    def _get_password_pool(cls):
+        """ Return the password worker pool, creating it on first use """
+        with cls._password_pool_lock:
+            if cls._password_pool is None:
+                cls._password_pool = ProcessPoolExecutor(max_workers=settings['CRYPT_WORKERS'])
+            return cls._password_pool
+
+    @classmethod
+    def _get_bg_executor(cls):
+        """ Return the background DB write pool, creating it on first use """
+        with cls._bg_executor_lock:
+            if cls._bg_executor is None:
+                cls._bg_executor = ThreadPoolExecutor(max_workers=2)
+            return cls._bg_executor
+
+    def _update_password_hash(self, user, new_hash):
+        """
+        Store the upgraded password hash of user in the background
+
+        The cached user data is dropped once the hash is written, so the
+        next login verifies against the new hash.
+        """
+        future = self._get_bg_executor().submit(self.db.update_user_hash,
+                                                user.id, new_hash)
+        future.add_done_callback(lambda f: self._hash_updated(user, f))
+
+    def _hash_updated(self, user, future):
+        """ Done callback of _update_password_hash """
+        if future.exception() is not None:
+            logger.error('[%s] Failed to update password hash: %s',
+                         user.name, future.exception())
+        self.invalidate(user.name)
+
+    def _dummy_verify(self):
+        """
+        Burn the time of a password verification
+
+        Called before raising on paths which don't validate the password,
+        so response time doesn't reveal whether a username exists.
+        """
+        self.pwd_context.verify('dummy', self._dummy_hash)
+
+    @staticmethod
+    def _otp_syntactically_valid(otp):
+        """
+        Check the OTP length and alphabet, without touching the DB or the network
+
+        >>> Client._otp_syntactically_valid('ccccccbcgujhingjrdejhgfnuetrgigvejhhgbkugded')
+        True
+        >>> Client._otp_syntactically_valid('ccccccbcgujhingjrdejhgfnuetrgigvejhhgbkugdex')
+        False
+        """
+        return TOKEN_LEN <= len(otp) <= OTP_MAX_LEN and not otp.strip(MODHEX_CHARS)
+
+    def _get_user_info(self, username, token_id, dummy_verify=True):
+        """
+        Get user and its token from DB
 
         Args:
             username
+            token_id: Token prefix (aka. publicname)
+            dummy_verify: Run _dummy_verify() before raising
 
         Returns:
-            dictionary of user data
+            User, with the token data if the token is associated with the user
 
         Raises:
             AuthFail if user does not exist
         """
-        user = self.db.get_user(username)
-        if not user:
+        user = self._user_cache.get((username, token_id))
+        if user is None:
+            row = self.db.get_user_with_token(username, token_id)
+            if row:
+                user = self._build_user(row)
+                self._user_cache.set((username, token_id), user)
+        if user is None:
+            if dummy_verify:
+                self._dummy_verify()
             raise YKAuthError('UNKNOWN_USER')
         logger.debug('[%s] Found user: %s', username, user)
         return user
 
-    def _check_token(self, user, token_id):
+    @staticmethod
+    def _build_user(row):
+        """ Build a User from a DBHandler.get_user_with_token row """
+        token = None
+        if row['yubikeys_id']:
+            token = Token(row['yubikeys_id'], row['yubikeys_prefix'],
+                          bool(row['yubikeys_enabled']),
+                          row['yubikeys_attribute_association_id'])
+        return User(row['users_id'], row['users_name'], row['users_auth'],
+                    row['users_attribute_association_id'], token)
+
+    def _check_token(self, user, token_id, dummy_verify=True):
         """
         Check Token association with user
 
         Args:
-            user: User data dict as recieved from _get_user_info()
+            user: User as recieved from _get_user_info()
             token_id: Token prefix (aka. publicname)
+            dummy_verify: Run _dummy_verify() before raising
 
         Returns:
             None
@@ -114,28 +492,37 @@ class Client:
             AuthFail if token is not associated with the user
             AithFail if token is disabled
         """
-        token = self.db.get_token(user['users_id'], token_id)
-        if not token:
+        if user.token is None:
             logger.error('[%s] Token %s is not associated with user',
-                         user['users_name'], token_id)
+                         user.name, token_id)
+            if dummy_verify:
+                self._dummy_verify()
             raise YKAuthError('INVALID_TOKEN')
-        logger.debug('[%s] Found token: %s', user['users_name'], token)
-        if not token.get('yubikeys_enabled'):
+        logger.debug('[%s] Found token: %s', user.name, token_id)
+        if not user.token.enabled:
             logger.error('[%s] Token %s is disabled for %s',
-                         user['users_name'], token_id, user['users_name'])
+                         user.name, token_id, user.name)
+            if dummy_verify:
+                self._dummy_verify()
             raise YKAuthError('DISABLED_TOKEN')
 
     def _validate_password(self, user, password):
         """
         Validate password against the hash in SQL
         """
-        valid, new_hash = self.pwd_context.verify_and_update(str(password), user['users_auth'])
+        valid, new_hash = self.pwd_context.verify_and_update(str(password), user.auth)
+        return self._check_password_result(user, valid, new_hash)
+
+    def _check_password_result(self, user, valid, new_hash):
+        """
+        Handle the result of a password verification
+        """
         if not valid:
-            logger.error('[%(users_name)s] Invalid password', user)
+            logger.error('[%s] Invalid password', user.name)
             raise YKAuthError('BAD_PASSWORD')
         if new_hash:
-            # TODO: update user's hash with new_hash
-            logger.warning('[%(users_name)s] User password hash needs update', user)
+            logger.warning('[%s] User password hash needs update', user.name)
+            self._update_password_hash(user, new_hash)
         return True
 
     def authenticate(self, username, password, otp):
@@ -151,14 +538,20 @@ class Client:
             dict of authentication data
 
         Authentication process:
+            0. Check the OTP format
             1. Check if token is enabled
             2. Check if token is associated with the user & enabled
             3. Validate users password
             4. Validate OTP (YKVal)
         """
+        # STEP 0: Reject malformed OTPs before any lookup
+        if not self._otp_syntactically_valid(otp):
+            logger.error('[%s] Invalid OTP format: %s', username, otp)
+            self._dummy_verify()
+            raise YKAuthError('BAD_OTP')
         token_id = otp[:-TOKEN_LEN]
         # STEP 1: Check if token is enabled
-        user = self._get_user_info(username)
+        user = self._get_user_info(username, token_id)
         # STEP 2: Check if token is associated with the user & enabled
         self._check_token(user, token_id)
         # STEP 3: Validate users password
@@ -166,3 +559,36 @@ class Client:
         # STEP 4: Validate OTP
         self.ykval_client.verify(otp)
         return True
+
+    async def authenticate_async(self, username, password, otp):
+        """
+        Coroutine version of authenticate()
+
+        The blocking steps (DB lookups, OTP validation) run in the event
+        loop's default executor, password hashing runs in a process pool
+        so concurrent authentications can use every CPU core.
+        """
+        loop = asyncio.get_running_loop()
+        password_pool = self._get_password_pool()
+        token_id = otp[:-TOKEN_LEN]
+        try:
+            # STEP 0: Reject malformed OTPs before any lookup
+            if not self._otp_syntactically_valid(otp):
+                logger.error('[%s] Invalid OTP format: %s', username, otp)
+                raise YKAuthError('BAD_OTP')
+            # STEP 1: Check if token is enabled
+            user = await loop.run_in_executor(None, self._get_user_info, username, token_id, False)
+            # STEP 2: Check if token is associated with the user & enabled
+            self._check_token(user, token_id, dummy_verify=False)
+        except YKAuthError:
+            # Same cost as a password verify, through the same pool
+            await loop.run_in_executor(password_pool, _verify_password, 'dummy',
+                                       self._dummy_hash, settings['CRYPT_CONTEXT'])
+            raise
+        # STEP 3: Validate users password
+        valid, new_hash = await loop.run_in_executor(password_pool, _verify_password, str(password),
+                                                     user.auth, settings['CRYPT_CONTEXT'])
+        self._check_password_result(user, valid, new_hash)
+        # STEP 4: Validate OTP
+        await loop.run_in_executor(None, self.ykval_client.verify, otp)
+        return True
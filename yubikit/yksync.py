@@ -5,16 +5,14 @@ yubikit.ykval
 Python Yubikey Stack - Key validation module
 """
 
+from concurrent.futures import (
+    ThreadPoolExecutor,
+    TimeoutError as FutureTimeoutError,
+    as_completed,
+)
 import logging
-try:
-    import queue
-except ImportError:
-    import Queue as queue
 import re
 import threading
-import time
-
-import requests
 
 from .config import settings
 from .db import DBHandler
@@ -24,6 +22,7 @@ from .utils import (
     counters_eq,
     counters_gt,
     counters_gte,
+    http_session,
     parse_sync_response,
 )
 
@@ -33,21 +32,49 @@ requests_log.setLevel(logging.WARNING if logger.getEffectiveLevel() != 10 else l
 
 REQUIRED_PARAMS = ['modified', 'otp', 'nonce', 'yk_publicname',
                    'yk_counter', 'yk_use', 'yk_high', 'yk_low']
+_REQUIRED_PARAMS_SET = frozenset(REQUIRED_PARAMS)
+# Parameters which have to be integers (or '-1'), in REQUIRED_PARAMS order
+_INT_PARAMS = tuple(param for param in REQUIRED_PARAMS
+                    if param not in ('otp', 'nonce', 'yk_publicname'))
+YK_RE = re.compile(r'^([cbdefghijklnrtuv]{0,16}|all)$')
 
 
 class Sync(object):
     """ Sync object to handle cross synchronization requests """
+    # HTTP session and thread pool shared by every Sync, so the sync
+    # requests reuse keep-alive connections and no thread is started
+    # per request
+    _shared_session = None
+    _shared_executor = None
+    _shared_lock = threading.Lock()
+
     def __init__(self, db=None):
         self.db = db if db else DBHandler(db='ykval')
         self.sync_servers = settings['SYNC_SERVERS']
+        self._session, self._executor = self._get_shared(len(self.sync_servers))
+
+    @classmethod
+    def _get_shared(cls, server_count):
+        """ Return the shared HTTP session and thread pool, creating them on first use """
+        with cls._shared_lock:
+            if cls._shared_session is None:
+                cls._shared_session = http_session(pool_connections=max(server_count, 1),
+                                                   pool_maxsize=32)
+                # By default room for a few concurrent validations syncing with every server
+                workers = settings['SYNC_POOL_SIZE'] or max(server_count, 1) * 4
+                cls._shared_executor = ThreadPoolExecutor(max_workers=workers,
+                                                          thread_name_prefix='ykval-sync')
+            return cls._shared_session, cls._shared_executor
 
     def check_sync_input(self, sync_params):
         """ Check for all required parameters """
-        for req_param in REQUIRED_PARAMS:
-            if req_param not in sync_params:
-                logger.error("Received request with missing '%s' parameter", req_param)
-                raise YKSyncError('MISSING_PARAMETER', req_param)
-            if req_param not in ('otp', 'nonce', 'yk_publicname') and not (sync_params[req_param] == '-1' or isinstance(sync_params[req_param], int)):
+        if not _REQUIRED_PARAMS_SET.issubset(sync_params):
+            req_param = next(param for param in REQUIRED_PARAMS if param not in sync_params)
+            logger.error("Received request with missing '%s' parameter", req_param)
+            raise YKSyncError('MISSING_PARAMETER', req_param)
+        for req_param in _INT_PARAMS:
+            value = sync_params[req_param]
+            if not (type(value) is int or value == '-1'):
                 logger.error("Input parameter '%s' is not correct", req_param)
                 raise YKSyncError('INVALID_PARAMETER', req_param)
 
@@ -56,7 +83,7 @@ class Sync(object):
         if 'yk' not in resync_params:
             logger.error("Received request with missing 'yk' parameter")
             raise YKSyncError('MISSING_PARAMETER', 'yk')
-        if not re.match(r'^([cbdefghijklnrtuv]{0,16}|all)$', resync_params['yk']):
+        if not YK_RE.match(resync_params['yk']):
             logger.error("Invalid 'yk' value: %(yk)s", resync_params)
             raise YKSyncError('INVALID_PARAMETER', 'yk')
 
@@ -64,14 +91,16 @@ class Sync(object):
         """ Synchronize """
         self.check_sync_input(sync_params)
         local_params = self.db.get_local_params(sync_params['yk_publicname'])
-        self.db.update_db_counters(sync_params)
         logger.debug('[%s] Local params: %s',
                      sync_params['yk_publicname'], local_params)
         logger.debug('[%s] Sync request params: %s',
                      sync_params['yk_publicname'], sync_params)
 
         if counters_gte(local_params, sync_params):
+            # The conditional UPDATE would not change anything
             logger.warning('[%(yk_publicname)s] Remote server out of sync', sync_params)
+        else:
+            self.db.update_db_counters(sync_params)
 
         if counters_eq(local_params, sync_params):
             if sync_params['modified'] == local_params['modified'] and sync_params['nonce'] == local_params['nonce']:
@@ -110,52 +139,61 @@ class Sync(object):
     def resync_local(self, resync_params):
         """ Re-synchronize """
         self.check_resync_input(resync_params)
-        keys = self.db.get_keys(resync_params['yk'])
         server_nonce = generate_nonce()
-        for key in keys:
-            local_params = self.db.get_local_params(key['yk_publicname'])
+        params = []
+        for local_params in self.db.get_keys_local_params(resync_params['yk']):
             local_params['otp'] = 'c' * 32  # Fake an OTP
             logger.debug('Auth data: %s', local_params)
-            for server in self.sync_servers:
-                self.db.enqueue(local_params, local_params, server, server_nonce)
+            params.append((local_params, local_params))
+        self.db.enqueue_many(params, self.sync_servers, server_nonce)
         return 'OK Initiated resync of %(yk)s' % resync_params
 
-    def _fetch_remote(self, dqueue, server, url, timeout):
-        """ Make HTTP GET call to remote server """
+    def _fetch_remote(self, server, url, timeout):
+        """
+        Make HTTP GET call to remote server
+
+        Returns:
+            dict of the server and its parsed response, None on failure
+        """
         try:
-            req = requests.get(url, timeout=timeout)
+            req = self._session.get(url, timeout=timeout)
             if req.status_code == 200:
                 try:
-                    resp_params = parse_sync_response(req.text)
-                    dqueue.put({'server': server, 'params': resp_params})
+                    return {'server': server, 'params': parse_sync_response(req.text)}
                 except ValueError as err:
                     logger.error('Failed to parse response of %s: %s', server, err)
             else:
                 logger.warning('Recieved status code %s for %s', req.status_code, url)
         except Exception as err:
             logger.warning('Failed to retrieve %s: %s', url, err)
+        return None
 
     def sync_remote(self, otp_params, local_params, server_nonce, required_answers, timeout=1):
         """ Function to synchronize values with other ykval servers """
         # Construct URLs
         responses = []
-        dqueue = queue.Queue()
+        futures = []
         for row in self.db.get_queue(otp_params['modified'], server_nonce):
             url = '%(server)s?otp=%(otp)s&modified=%(modified)s' % row
             url += '&' + row['info'].split(',')[0]
-            _thread = threading.Thread(target=self._fetch_remote,
-                                       args=(dqueue, row['server'], url, timeout))
-            _thread.daemon = True
-            _thread.start()
-        loop_start = time.time()
-        while len(responses) < required_answers and time.time() < loop_start + timeout * 1.5:
-            try:
-                resp = dqueue.get(timeout=0.2)
+            futures.append(self._executor.submit(self._fetch_remote, row['server'], url, timeout))
+        try:
+            for future in as_completed(futures, timeout=timeout * 1.5):
+                resp = future.result()
+                if resp is None:
+                    continue
                 responses.append(resp)
                 # Delete entry from table
                 self.db.remove_from_queue(resp['server'], otp_params['modified'], server_nonce)
-            except queue.Empty:
-                pass
+                if len(responses) >= required_answers:
+                    break
+        except FutureTimeoutError:
+            pass
+        finally:
+            # Requests not started yet are dropped, the queue daemon
+            # takes care of their servers
+            for future in futures:
+                future.cancel()
 
         answers = len(responses)
         # Parse response
@@ -6,12 +6,12 @@ Python Yubikey Stack - Key validation module
 """
 
 import base64
-from datetime import datetime
+from contextlib import contextmanager
 import logging
-import re
+import threading
 import time
 
-import requests
+from requests.adapters import Retry
 
 from .config import (
     settings,
@@ -20,20 +20,107 @@ from .config import (
     TOKEN_LEN,
     OTP_MAX_LEN,
 )
-from .db import DBHandler
+from .db import DBHandler, get_redis
 from .exceptions import YKValError
 from .utils import (
+    MODHEX_CHARS,
     generate_nonce,
     counters_eq,
     counters_gte,
+    http_session,
+    TTLCache,
 )
 from .yksync import Sync
 
 logger = logging.getLogger(__name__)
 
+# Decoded client secrets by client id, shared by every Validator. Unknown
+# ids are cached as _NO_SUCH_CLIENT, so they don't query the DB either.
+_CLIENT_CACHE = TTLCache(settings['CLIENT_CACHE_SIZE'], settings['CLIENT_CACHE_TTL'])
+_NO_SUCH_CLIENT = object()
+
+# OTPs being validated by this process. The TTL only matters if an entry
+# is leaked, they are removed when their validation ends.
+_INFLIGHT = TTLCache(100000, 60)
+_INFLIGHT_LOCK = threading.Lock()
+
+# Delete a replay cache entry only if it still holds the nonce of the request
+# KEYS[1]: cache key, ARGV[1]: nonce
+RELEASE_REPLAY_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def clear_client_cache():
+    """ Forget the cached client secrets, e.g. after rotating one """
+    _CLIENT_CACHE.clear()
+
+
+def check_v2_params(otp, client_id, nonce, timeout, sync_level):
+    """
+    Perform Sanity check on the parameters of a verify request
+
+    Takes the parameters one by one, so verify can check them before
+    building its params dict.
+    """
+    # OTP
+    if not TOKEN_LEN <= len(otp) <= OTP_MAX_LEN:
+        logger.error('[%s] Incorrect OTP length: %s', '?' * 12, otp)
+        raise YKValError('BAD_OTP')
+    token_id = otp[:-TOKEN_LEN]
+    if otp.strip(MODHEX_CHARS):
+        logger.error('[%s] Invalid OTP: %s', token_id, otp)
+        raise YKValError('BAD_OTP')
+    # CLIENT ID
+    if client_id and not isinstance(client_id, int):
+        logger.error('[%s] id provided in request '
+                     '(%s must be an integer', token_id, client_id)
+        raise YKValError('INVALID_PARAMETER', 'client_id')
+    # NONCE:
+    # - If client_id is not provided, we're using a Native stack call
+    if client_id and not nonce:
+        logger.error('[%s] Nonce is missing', token_id)
+        raise YKValError('MISSING_PARAMETER', 'nonce')
+    if nonce:
+        if not (nonce.isascii() and nonce.isalnum()):
+            logger.error('[%s] Nonce is provided but not correct', token_id)
+            raise YKValError('INVALID_PARAMETER', 'nonce')
+        if not 16 <= len(nonce) <= 40:
+            logger.error('[%s] Nonce too short or too long (%s)', token_id, nonce)
+            raise YKValError('INVALID_PARAMETER', 'nonce')
+    # TIMESTAMP
+    #   NOTE: Timestamp parameter is not checked since current protocol says
+    #   that 1 means request timestamp and anything else is discarded.
+    # TIMEOUT
+    if not isinstance(timeout, int):
+        logger.error('[%s] timeout is provided but not correct (%s)', token_id, timeout)
+        raise YKValError('INVALID_PARAMETER', 'timeout')
+    # SYNC LEVEL
+    if not (isinstance(sync_level, int) and 0 <= sync_level <= 100):
+        logger.error('[%s] SL (sync level) is provided but '
+                     'not correct (%s)', token_id, sync_level)
+        raise YKValError('INVALID_PARAMETER', 'sync_level')
+
+
+def response_time():
+    """
+    UTC time of a verify response, with the 4 digit sub-second part after the Z
+    as the YK-VAL servers format it, e.g. 2015-04-14T20:07:20Z5261
+    """
+    seconds, nanoseconds = divmod(time.time_ns(), 1000000000)
+    return '%sZ%04d' % (time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(seconds)), nanoseconds // 100000)
+
 
 class Validator:
     """ Yubikey OTP validator """
+    # HTTP session shared by every Validator, so keep-alive connections
+    # to the KSM servers survive across validations
+    _ksm_session = None
+    _ksm_session_lock = threading.Lock()
+
     def __init__(self):
         self.db = DBHandler(db='ykval')
         if settings['USE_NATIVE_YKKSM']:
@@ -43,50 +130,87 @@ class Validator:
             self.decryptor = None
         self.sync_servers = settings['SYNC_SERVERS']
         self.default_sync_level = settings['SYNC_LEVEL']
+        self.replay_cache = None
+        if settings['REDIS_URL']:
+            self.replay_cache = get_redis(settings['REDIS_URL'])
+            self._release_replay = self.replay_cache.register_script(RELEASE_REPLAY_LUA)
         # Below parameters are valid from protocol version >= 2.0
         self.sync_level = None
         self.timeout = None
 
     def check_parameters(self, params):
         """ Perform Sanity check on parameters """
-        params['token_id'] = '?' * 12
-        # OTP
-        if not TOKEN_LEN <= len(params['otp']) <= OTP_MAX_LEN:
-            logger.error('[%(token_id)s] Incorrect OTP length: %(otp)s', params)
-            raise YKValError('BAD_OTP')
+        check_v2_params(params['otp'], params['client_id'], params['nonce'],
+                        params['timeout'], params['sync_level'])
         params['token_id'] = params['otp'][:-TOKEN_LEN]
-        if not re.match(r'^[cbdefghijklnrtuv]+$', params['otp']):
-            logger.error('[%(token_id)s] Invalid OTP: %(otp)s', params)
-            raise YKValError('BAD_OTP')
-        # CLIENT ID
-        if params['client_id'] and not isinstance(params['client_id'], int):
-            logger.error('[%(token_id)s] id provided in request '
-                         '(%(client_id)s must be an integer', params)
-            raise YKValError('INVALID_PARAMETER', 'client_id')
-        # NONCE:
-        # - If client_id is not provided, we're using a Native stack call
-        if params['client_id'] and not params['nonce']:
-            logger.error('[%(token_id)s] Nonce is missing', params)
-            raise YKValError('MISSING_PARAMETER', 'nonce')
-        if params['nonce'] and not re.match(r'^[A-Za-z0-9]+$', params['nonce']):
-            logger.error('[%(token_id)s] Nonce is provided but not correct', params)
-            raise YKValError('INVALID_PARAMETER', 'nonce')
-        if params['nonce'] and not 16 <= len(params['nonce']) <= 40:
-            logger.error('[%(token_id)s] Nonce too short or too long (%(nonce)s)', params)
-            raise YKValError('INVALID_PARAMETER', 'nonce')
-        # TIMESTAMP
-        #   NOTE: Timestamp parameter is not checked since current protocol says
-        #   that 1 means request timestamp and anything else is discarded.
-        # TIMEOUT
-        if not isinstance(params['timeout'], int):
-            logger.error('[%(token_id)s] timeout is provided but not correct (%(timeout)s)',
-                         params)
-            raise YKValError('INVALID_PARAMETER', 'timeout')
-        # SYNC LEVEL
-        if not (isinstance(params['sync_level'], int) and 0 <= params['sync_level'] <= 100):
-            logger.error('[%(token_id)s] SL (sync level) is provided but '
-                         'not correct (%(sync_level)s)', params)
-            raise YKValError('INVALID_PARAMETER', 'sync_level')
+
+    def check_replay_cache(self, params):
+        """
+        Reject OTPs already seen by this cluster, without touching the DB
+
+        The OTP is recorded in Redis with its nonce for REDIS_OTP_TTL seconds.
+        If Redis can't be reached the check is skipped, the counters in the DB
+        still catch the replay.
+
+        Raises:
+            YKValError('REPLAYED_REQUEST') if the OTP was seen with the same nonce
+            YKValError('REPLAYED_OTP') if the OTP was seen with another nonce
+        """
+        if self.replay_cache is None:
+            return
+        from redis import RedisError
+        key = 'ykval:otp:%s' % params['otp']
+        try:
+            if self.replay_cache.set(key, params['nonce'], nx=True, ex=settings['REDIS_OTP_TTL']):
+                return
+            seen_nonce = self.replay_cache.get(key)
+        except RedisError as err:
+            logger.warning('[%s] Replay cache unavailable: %s', params['token_id'], err)
+            return
+        if seen_nonce == params['nonce']:
+            logger.error('[%(token_id)s] Replayed request (OTP: %(otp)s, Nonce: %(nonce)s)', params)
+            raise YKValError('REPLAYED_REQUEST')
+        logger.error('[%(token_id)s] Replayed OTP: %(otp)s', params)
+        raise YKValError('REPLAYED_OTP')
+
+    def release_replay_cache(self, params):
+        """
+        Forget the OTP recorded by check_replay_cache
+
+        Called when the validation fails before the counters are committed,
+        so the OTP can be retried. The entry is only deleted if it still
+        holds the nonce of this request.
+        """
+        if self.replay_cache is None:
+            return
+        from redis import RedisError
+        try:
+            self._release_replay(keys=['ykval:otp:%s' % params['otp']], args=[params['nonce']])
+        except RedisError as err:
+            logger.warning('[%s] Failed to release replay cache entry: %s', params['token_id'], err)
+
+    @contextmanager
+    def _otp_in_flight(self, params):
+        """
+        Mark the OTP as being validated for the duration of the with block
+
+        A second request for the same OTP arriving meanwhile (client retry,
+        double submit) is rejected right away, instead of racing through
+        the DB and the sync requests.
+
+        Raises:
+            YKValError('REPLAYED_REQUEST') if the OTP is already being validated
+        """
+        otp = params['otp']
+        with _INFLIGHT_LOCK:
+            if _INFLIGHT.get(otp) is not None:
+                logger.error('[%(token_id)s] OTP is already being validated: %(otp)s', params)
+                raise YKValError('REPLAYED_REQUEST')
+            _INFLIGHT.set(otp, True)
+        try:
+            yield
+        finally:
+            _INFLIGHT.pop(otp)
 
     def get_client_apikey(self, client_id):
         """
@@ -104,12 +228,27 @@ class Validator:
         """
         if not client_id:
             return ''.encode()
-        client_data = self.db.get_client_data(client_id)
-        logger.debug('Client data: %s', client_data)
-        if not client_data:
+        apikey = _CLIENT_CACHE.get(client_id)
+        if apikey is None:
+            client_data = self.db.get_client_data(client_id)
+            logger.debug('Client data: %s', client_data)
+            apikey = base64.b64decode(client_data['secret']) if client_data else _NO_SUCH_CLIENT
+            _CLIENT_CACHE.set(client_id, apikey)
+        if apikey is _NO_SUCH_CLIENT:
             logger.error('Invalid client id: %s', client_id)
             raise YKValError('NO_SUCH_CLIENT')
-        return base64.b64decode(client_data['secret'])
+        return apikey
+
+    @classmethod
+    def _get_ksm_session(cls):
+        """ Return the shared KSM HTTP session, creating it on first use """
+        with cls._ksm_session_lock:
+            if cls._ksm_session is None:
+                retries = Retry(total=1, backoff_factor=0.05)
+                cls._ksm_session = http_session(pool_connections=max(len(settings['YKKSM_SERVERS']), 1),
+                                                pool_maxsize=32,
+                                                max_retries=retries)
+            return cls._ksm_session
 
     def decode_otp(self, otp):
         """
@@ -117,21 +256,19 @@ class Validator:
         """
         if self.decryptor:
             data = self.decryptor.decrypt(otp)
-            return dict([(k, int(v, 16)) for k, v in data.items()])
+            return {k: int(v, 16) for k, v in data.items()}
         elif settings['YKKSM_SERVERS']:
             # TODO: Support for async req for multiple servers
+            session = self._get_ksm_session()
             for url in settings['YKKSM_SERVERS']:
-                req = requests.get(url, params={'otp': otp}, headers={'Accept': 'application/json'})
+                req = session.get(url, params={'otp': otp}, headers={'Accept': 'application/json'})
                 logger.debug('[%s] YK-KSM response: %s (status_code: %s)',
                              otp[:-TOKEN_LEN], req.text, req.status_code)
                 if req.headers['Content-Type'] == 'application/json' and req.status_code == 200:
-                    return dict([(k, int(v, 16)) for k, v in req.json().items()])
+                    return {k: int(v, 16) for k, v in req.json().items()}
                 if req.text.startswith('OK'):
-                    resp = {}
-                    for i in req.text.split()[1:]:
-                        key, val = i.split('=')
-                        resp[key] = int(val, 16)
-                    return resp
+                    return {key: int(val, 16)
+                            for key, _, val in (item.partition('=') for item in req.text.split()[1:])}
             raise YKValError('BAD_OTP')
         logger.error("No KSM service provided. Can't decrypt OTP.")
         raise YKValError('BACKEND_ERROR', 'No KSM service found')
@@ -161,13 +298,17 @@ class Validator:
             logger.error('[%s] Replayed OTP: Local counters higher (%s > %s)',
                          otp_params['yk_publicname'], local_params, otp_params)
             raise YKValError('REPLAYED_OTP')
-        # Valid OTP, update DB
-        self.db.update_db_counters(otp_params)
+        # Valid OTP, update DB. The UPDATE only applies to lower counters, if it
+        # didn't change anything another request validated this OTP (or a later
+        # one) since local_params were read.
+        if not self.db.update_db_counters(otp_params):
+            logger.error('[%(yk_publicname)s] Replayed OTP: counters updated concurrently '
+                         '(OTP: %(otp)s, Nonce: %(nonce)s)', otp_params)
+            raise YKValError('REPLAYED_OTP')
 
     def replicate(self, otp_params, local_params, server_nonce):
         """ Handle sync across the cluster """
-        for server in settings['SYNC_SERVERS']:
-            self.db.enqueue(otp_params, local_params, server, server_nonce)
+        self.db.enqueue_many([(otp_params, local_params)], settings['SYNC_SERVERS'], server_nonce)
 
         req_answers = round(len(self.sync_servers) * float(self.sync_level) / 100.0)
         if req_answers:
@@ -282,66 +423,78 @@ class Validator:
         self.timeout = timeout if timeout else settings['SYNC_TIMEOUT']
         self.sync_level = sync_level if sync_level else settings['SYNC_LEVEL']
         server_nonce = generate_nonce()
+        nonce = nonce if nonce else server_nonce
+        # Check sanity of parameters
+        check_v2_params(otp, client_id, nonce, self.timeout, self.sync_level)
         params = {
             'client_id': client_id,
             'otp': otp,
-            'nonce': nonce if nonce else server_nonce,
+            'token_id': otp[:-TOKEN_LEN],
+            'nonce': nonce,
             'timestamp': timestamp,
             'timeout': self.timeout,
             'sync_level': self.sync_level,
         }
         extra_params = {
             'otp': otp,
-            'nonce': params['nonce']
-        }
-        # Check sanity of parameters
-        self.check_parameters(params)
-
-        #####################
-        # STEP 2: decrypt OTP
-        #####################
-        otp_info = self.decode_otp(otp)
-
-        #######################################
-        # STEP 3: compare old OTP counters with
-        #         the given OTP counters and
-        #         check for replay
-        #######################################
-        # Get old parameters (counters) for the token
-        local_params = self.db.get_local_params(otp[:-TOKEN_LEN])
-        if not local_params['active']:
-            logger.error('[%(yk_publicname)s]: De-activated Yubikey', local_params)
-            raise YKValError('DISABLED_TOKEN')
-        # Build the new parameters (counters) for the given OTP
-        otp_params = self.build_otp_params(params, otp_info)
-        # Validate OTP, check for replayed request or replayed OTP
-        self.validate_otp(otp_params, local_params)
-
-        #####################################
-        # STEP 4: replicate new OTP counters
-        #         to remote servers and check
-        #         for replay on other servers
-        #####################################
-        sync_level_success_rate = self.replicate(otp_params, local_params, server_nonce)
-
-        #######################################
-        # STEP 5: check for phishing, OTP has
-        #         to be used within a timeframe
-        #         otherwise mark as expired
-        #######################################
-        self.phishing_test(otp_params, local_params)
-
-        ##########################
-        # STEP 6: Prepare response
-        ##########################
-        extra_params['sl'] = sync_level_success_rate
-        if timestamp == 1:
-            extra_params['timestamp'] = (otp_info['yk_high'] << 16) + otp_info['yk_low']
-            extra_params['sessioncounter'] = otp_info['yk_counter']
-            extra_params['sessionuse'] = otp_info['yk_use']
-        response = {
-            'status': 'OK',
-            'time': datetime.utcnow().isoformat().replace('.', 'Z')[:-2]
+            'nonce': nonce
         }
-        response.update(extra_params)
-        return response
+        # Bounce concurrent submissions of the same OTP, before anything
+        # is recorded in the replay cache
+        with self._otp_in_flight(params):
+            # Short-circuit the replays already known to the cache
+            self.check_replay_cache(params)
+            # Until the counters are committed, a failure must not leave
+            # the OTP burned in the replay cache
+            try:
+                #####################
+                # STEP 2: decrypt OTP
+                #####################
+                otp_info = self.decode_otp(otp)
+
+                #######################################
+                # STEP 3: compare old OTP counters with
+                #         the given OTP counters and
+                #         check for replay
+                #######################################
+                # Get old parameters (counters) for the token
+                local_params = self.db.get_local_params(otp[:-TOKEN_LEN])
+                if not local_params['active']:
+                    logger.error('[%(yk_publicname)s]: De-activated Yubikey', local_params)
+                    raise YKValError('DISABLED_TOKEN')
+                # Build the new parameters (counters) for the given OTP
+                otp_params = self.build_otp_params(params, otp_info)
+                # Validate OTP, check for replayed request or replayed OTP
+                self.validate_otp(otp_params, local_params)
+            except Exception:
+                self.release_replay_cache(params)
+                raise
+
+            #####################################
+            # STEP 4: replicate new OTP counters
+            #         to remote servers and check
+            #         for replay on other servers
+            #####################################
+            sync_level_success_rate = self.replicate(otp_params, local_params, server_nonce)
+
+            #######################################
+            # STEP 5: check for phishing, OTP has
+            #         to be used within a timeframe
+            #         otherwise mark as expired
+            #######################################
+            self.phishing_test(otp_params, local_params)
+
+            ##########################
+            # STEP 6: Prepare response
+            ##########################
+            extra_params['sl'] = sync_level_success_rate
+            if timestamp == 1:
+                extra_params['timestamp'] = (otp_info['yk_high'] << 16) + otp_info['yk_low']
+                extra_params['sessioncounter'] = otp_info['yk_counter']
+                extra_params['sessionuse'] = otp_info['yk_use']
+            response = {
+                'status': 'OK',
+                'time': response_time(),
+            }
+            response.update(extra_params)
+            return response